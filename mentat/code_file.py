@@ -53,6 +53,23 @@ class CodeFile:
                 self.intervals = [Interval(0, math.inf)]
             else:
                 self.intervals = parse_intervals(split[1])
+        self._line_mask: bytes | None = None
 
     def contains_line(self, line_number: int):
         return any([interval.contains(line_number) for interval in self.intervals])
+
+    def line_mask(self, num_lines: int) -> bytes:
+        """
+        Returns a mask of length num_lines where mask[i] is set if line i + 1 is in
+        context, for use with itertools.compress.
+        """
+        if self._line_mask is not None and len(self._line_mask) == num_lines:
+            return self._line_mask
+        mask = bytearray(num_lines)
+        for interval in self.intervals:
+            start = max(int(interval.start), 1)
+            end = min(interval.end, num_lines)
+            if start <= end:
+                mask[start - 1 : int(end)] = b"\x01" * (int(end) - start + 1)
+        self._line_mask = bytes(mask)
+        return self._line_mask
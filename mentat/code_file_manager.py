@@ -1,7 +1,11 @@
+import io
 import logging
 import math
 import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import compress, islice
+from operator import attrgetter
 from pathlib import Path
 from typing import Union
 
@@ -18,8 +22,11 @@ from .code_context import CodeContext
 from .code_file import CodeFile
 from .config_manager import ConfigManager
 from .errors import MentatError
+from .prompts import system_prompt_token_count
 from .user_input_manager import UserInputManager
 
+_WRITE_BUFFER_SIZE = 1 << 20
+
 
 class CodeFileManager:
     def __init__(
@@ -31,6 +38,22 @@ class CodeFileManager:
         self.user_input_manager = user_input_manager
         self.config = config
         self.code_context = code_context
+        # Maps rel_path -> (model, file_message, token count), so that unchanged
+        # files aren't re-tokenized every time the code message is built
+        self._token_cache = dict[Path, tuple[str, str, int]]()
+        self.file_lines = dict[Path, list[str]]()
+        self._file_stats = dict[Path, tuple[int, int]]()
+        # Maps abs_path -> (rel_path, posix rel_path)
+        self._rel_paths = dict[Path, tuple[Path, str]]()
+
+    def _get_rel_paths(self, abs_path: Path) -> tuple[Path, str]:
+        rel_paths = self._rel_paths.get(abs_path)
+        if rel_paths is None:
+            rel_path = Path(os.path.relpath(abs_path, self.config.git_root))
+            # We always want to give GPT posix paths
+            rel_paths = (rel_path, rel_path.as_posix())
+            self._rel_paths[abs_path] = rel_paths
+        return rel_paths
 
     def _read_file(self, file: Union[Path, CodeFile]) -> list[str]:
         if isinstance(file, CodeFile):
@@ -38,55 +61,111 @@ class CodeFileManager:
         else:
             rel_path = file
         abs_path = self.config.git_root / rel_path
-
-        with open(abs_path, "r") as f:
-            lines = f.read().split("\n")
-        return lines
+        return abs_path.read_text().split("\n")
 
     def _read_all_file_lines(self) -> None:
-        self.file_lines = dict[Path, list[str]]()
+        # Only re-read files whose (mtime, size) changed since the last call
+        file_lines = dict[Path, list[str]]()
+        file_stats = dict[Path, tuple[int, int]]()
+        stale_files = dict[Path, CodeFile]()
         for file in self.code_context.files.values():
-            rel_path = Path(os.path.relpath(file.path, self.config.git_root))
-            self.file_lines[rel_path] = self._read_file(file)
+            rel_path = self._get_rel_paths(file.path)[0]
+            stat = file.path.stat()
+            file_stats[rel_path] = (stat.st_mtime_ns, stat.st_size)
+            if (
+                rel_path in self.file_lines
+                and self._file_stats.get(rel_path) == file_stats[rel_path]
+            ):
+                file_lines[rel_path] = self.file_lines[rel_path]
+            else:
+                stale_files[rel_path] = file
+
+        # Reads release the GIL, so overlap them when there's more than one
+        if len(stale_files) > 1:
+            with ThreadPoolExecutor(max_workers=min(32, len(stale_files))) as executor:
+                file_lines.update(
+                    zip(
+                        stale_files.keys(),
+                        executor.map(self._read_file, stale_files.values()),
+                    )
+                )
+        else:
+            for rel_path, file in stale_files.items():
+                file_lines[rel_path] = self._read_file(file)
+        self.file_lines = file_lines
+        self._file_stats = file_stats
+
+    def _file_changed(self, rel_path: Path) -> bool:
+        # Only compare contents if the file was touched since we last read it
+        stat = (self.config.git_root / rel_path).stat()
+        if self._file_stats.get(rel_path) == (stat.st_mtime_ns, stat.st_size):
+            return False
+        return self.file_lines[rel_path] != self._read_file(rel_path)
+
+    def _count_file_tokens(self, rel_path: Path, file_message: str, model: str) -> int:
+        cached = self._token_cache.get(rel_path)
+        if cached is not None and cached[0] == model and cached[1] == file_message:
+            return cached[2]
+        tokens = count_tokens(file_message, model)
+        self._token_cache[rel_path] = (model, file_message, tokens)
+        return tokens
 
     def get_code_message(self, model: str) -> str:
-        code_message: list[str] = []
-        if self.code_context.diff_context.files:
-            code_message += [
-                "Diff References:",
-                f' "-" = {self.code_context.diff_context.name}',
-                ' "+" = Active Changes',
-                "",
-            ]
+        code_message = io.StringIO()
+        diff_context = self.code_context.diff_context
+        diff_files = diff_context.files
+        if diff_files:
+            code_message.write("Diff References:\n")
+            code_message.write(f' "-" = {diff_context.name}\n')
+            code_message.write(' "+" = Active Changes\n\n')
+        # Only fetch the diffs of files in context
+        diffs = diff_context.get_diffs(
+            (
+                self._get_rel_paths(file.path)[0]
+                for file in self.code_context.files.values()
+            ),
+            diff_files,
+        )
 
         self._read_all_file_lines()
-        code_message += ["Code Files:\n"]
+        code_message.write("Code Files:\n")
+        header = code_message.getvalue()
+        code_message_tokens = 0
         for file in self.code_context.files.values():
-            file_message: list[str] = []
-            abs_path = file.path
-            rel_path = Path(os.path.relpath(abs_path, self.config.git_root))
+            rel_path, posix_rel_path = self._get_rel_paths(file.path)
+            file_lines = self.file_lines[rel_path]
+            line_mask = file.line_mask(len(file_lines))
 
-            # We always want to give GPT posix paths
-            posix_rel_path = Path(rel_path).as_posix()
-            file_message.append(posix_rel_path)
-
-            for i, line in enumerate(self.file_lines[rel_path], start=1):
-                if file.contains_line(i):
-                    file_message.append(f"{i}:{line}")
+            file_message = [posix_rel_path]
+            file_message += [
+                f"{i}:{line}"
+                for i, line in compress(enumerate(file_lines, start=1), line_mask)
+            ]
             file_message.append("")
-
-            if rel_path in self.code_context.diff_context.files:
-                file_message = self.code_context.diff_context.annotate_file_message(
-                    rel_path, file_message
+            diff = diffs.get(rel_path)
+            if diff is not None:
+                file_message = diff_context.annotate_file_message(
+                    rel_path, file_message, diff
                 )
+            file_text = "\n".join(file_message)
 
-            code_message += file_message
+            code_message.write("\n")
+            code_message.write(file_text)
+            if self.code_context.code_map is not None:
+                code_message_tokens += self._count_file_tokens(
+                    rel_path, file_text, model
+                )
 
         if self.code_context.code_map is not None:
-            code_message_tokens = count_tokens("\n".join(code_message), model)
+            code_message_tokens += count_tokens(header, model)
             context_size = model_context_size(model)
             if context_size:
-                max_tokens_for_code_map = context_size - code_message_tokens
+                # The system prompt is sent alongside the code message
+                max_tokens_for_code_map = (
+                    context_size
+                    - system_prompt_token_count(model)
+                    - code_message_tokens
+                )
                 if self.code_context.code_map.token_limit:
                     code_map_message_token_limit = min(
                         self.code_context.code_map.token_limit, max_tokens_for_code_map
@@ -96,9 +175,16 @@ class CodeFileManager:
             else:
                 code_map_message_token_limit = self.code_context.code_map.token_limit
 
-            code_map_message = self.code_context.code_map.get_message(
-                token_limit=code_map_message_token_limit
-            )
+            if (
+                code_map_message_token_limit is not None
+                and code_map_message_token_limit <= 0
+            ):
+                # The code files alone fill the context, so don't build a code map
+                code_map_message = None
+            else:
+                code_map_message = self.code_context.code_map.get_message(
+                    token_limit=code_map_message_token_limit
+                )
             if code_map_message:
                 match (code_map_message.level):
                     case "signatures":
@@ -110,7 +196,8 @@ class CodeFileManager:
 
                 cprint_message = f"\nIncluding CodeMap ({cprint_message_level})"
                 cprint(cprint_message, color="green")
-                code_message += f"\n{code_map_message}"
+                code_message.write("\n\n")
+                code_message.write(code_map_message.content)
             else:
                 cprint_message = [
                     "\nExcluding CodeMap from system message.",
@@ -119,7 +206,7 @@ class CodeFileManager:
                 cprint_message = "\n".join(cprint_message)
                 cprint(cprint_message, color="yellow")
 
-        return "\n".join(code_message)
+        return code_message.getvalue()
 
     def _add_file(self, abs_path: Path):
         logging.info(f"Adding new file {abs_path} to context")
@@ -131,6 +218,10 @@ class CodeFileManager:
         logging.info(f"Deleting file {abs_path}")
         if abs_path in self.code_context.files:
             del self.code_context.files[abs_path]
+        rel_path = Path(os.path.relpath(abs_path, self.config.git_root))
+        self._rel_paths.pop(abs_path, None)
+        self._token_cache.pop(rel_path, None)
+        self._file_stats.pop(rel_path, None)
         abs_path.unlink()
 
     def _handle_delete(self, delete_change: CodeChange):
@@ -151,10 +242,10 @@ class CodeFileManager:
     ) -> list[str] | None:
         if not changes:
             return []
-        if len(set(map(lambda change: change.file, changes))) > 1:
+        if any(change.file != changes[0].file for change in changes):
             raise Exception("All changes passed in must be for the same file")
 
-        changes = sorted(changes, reverse=True)
+        changes = sorted(changes, key=attrgetter("last_changed_line"), reverse=True)
 
         # We resolve insertion conflicts twice because non-insertion conflicts
         # might move insert blocks outside of replace/delete blocks and cause
@@ -165,8 +256,9 @@ class CodeFileManager:
         if not changes:
             return []
 
-        new_code_lines = self.file_lines[rel_path].copy()
-        if new_code_lines != self._read_file(rel_path):
+        # CodeChange.apply returns new lists, so we don't need our own copy
+        new_code_lines = self.file_lines[rel_path]
+        if self._file_changed(rel_path):
             logging.info(f"File '{rel_path}' changed while generating changes")
             cprint(
                 f"File '{rel_path}' changed while generating; current file changes"
@@ -181,7 +273,7 @@ class CodeFileManager:
         last_line = len(new_code_lines) + 1
         largest_changed_line = math.ceil(changes[0].last_changed_line)
         if largest_changed_line > last_line:
-            new_code_lines += [""] * (largest_changed_line - last_line)
+            new_code_lines = new_code_lines + [""] * (largest_changed_line - last_line)
 
         min_changed_line = largest_changed_line + 1
         for change in changes:
@@ -191,6 +283,17 @@ class CodeFileManager:
             new_code_lines = change.apply(new_code_lines)
         return new_code_lines
 
+    def _write_lines(self, abs_path: Path, lines: list[str]) -> None:
+        with open(abs_path, "w", buffering=_WRITE_BUFFER_SIZE) as f:
+            if sum(map(len, lines)) < _WRITE_BUFFER_SIZE:
+                f.write("\n".join(lines))
+            elif lines:
+                # Stream large files rather than joining a second copy in memory
+                f.write(lines[0])
+                for line in islice(lines, 1, None):
+                    f.write("\n")
+                    f.write(line)
+
     def write_changes_to_files(self, code_changes: list[CodeChange]) -> None:
         file_changes = defaultdict[Path, list[CodeChange]](list)
         for code_change in code_changes:
@@ -200,22 +303,20 @@ class CodeFileManager:
                 case CodeChangeAction.CreateFile:
                     cprint(f"Creating new file {rel_path}", color="light_green")
                     self._add_file(abs_path)
-                    with open(abs_path, "w") as f:
-                        f.write("\n".join(code_change.code_lines))
+                    self._write_lines(abs_path, code_change.code_lines)
                 case CodeChangeAction.DeleteFile:
                     self._handle_delete(code_change)
                 case CodeChangeAction.RenameFile:
                     abs_new_path = self.config.git_root / code_change.name
                     self._add_file(abs_new_path)
                     code_lines = self.file_lines[rel_path]
-                    with open(abs_new_path, "w") as f:
-                        f.write("\n".join(code_lines))
+                    self._write_lines(abs_new_path, code_lines)
                     self._delete_file(abs_path)
-                    file_changes[code_change.name] += file_changes[rel_path]
-                    file_changes[rel_path] = []
-                    self.file_lines[code_change.name] = self._read_file(
-                        code_change.name
+                    file_changes[code_change.name].extend(
+                        file_changes.pop(rel_path, ())
                     )
+                    # We just wrote these lines, so there's no need to read them back
+                    self.file_lines[code_change.name] = code_lines
                 case _:
                     file_changes[rel_path].append(code_change)
 
@@ -227,5 +328,6 @@ class CodeFileManager:
                     raise MentatError(
                         f"Attempted to edit file {abs_path} not in context"
                     )
-                with open(abs_path, "w") as f:
-                    f.write("\n".join(new_code_lines))
+                self._write_lines(abs_path, new_code_lines)
+                self._token_cache.pop(rel_path, None)
+                self._file_stats.pop(rel_path, None)
@@ -11,7 +11,7 @@ from .llm_api import (
     model_context_size,
 )
 from .parsing import run_async_stream_and_parse_llm_response
-from .prompts import system_prompt
+from .prompts import system_prompt, system_prompt_token_count
 
 
 class Conversation:
@@ -47,7 +47,7 @@ class Conversation:
 
         tokens = count_tokens(
             code_file_manager.get_code_message(self.model), self.model
-        ) + count_tokens(system_prompt, self.model)
+        ) + system_prompt_token_count(self.model)
 
         context_size = model_context_size(self.model)
         maximum_context = config.maximum_context()
@@ -1,7 +1,8 @@
+import re
 import subprocess
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Literal, Optional
+from typing import Iterable, Literal, Optional
 
 from termcolor import cprint
 
@@ -10,6 +11,7 @@ from .errors import UserError
 from .git_handler import (
     check_head_exists,
     get_diff_for_file,
+    get_diffs_for_files,
     get_files_in_diff,
     get_treeish_metadata,
 )
@@ -25,29 +27,34 @@ class DiffAnnotation:
         return sum(bool(line.startswith("+")) for line in self.message)
 
 
+# Matches hunk headers (capturing the new start line) and +/- lines in a diff body
+_DIFF_LINE_RE = re.compile(
+    r"^(?:@@ -\S+ \+(?P<new_start>\d+)\S* @@.*|(?P<change>(?!---|\+\+\+)[+-].*))$",
+    re.MULTILINE,
+)
+
+# e.g. " 2 files changed, 10 insertions(+), 3 deletions(-)"
+_SHORTSTAT_RE = re.compile(r"(\d+) (file|insertion|deletion)")
+
+# Qualified branch names, e.g. "heads/main" or "refs/heads/main"
+_BRANCH_PREFIX_RE = re.compile(r"^(?:refs/)?heads/")
+
+
 def _parse_diff(diff: str) -> list[DiffAnnotation]:
     """Parse diff into a list of annotations."""
     annotations: list[DiffAnnotation] = []
-    active_annotation: Optional[DiffAnnotation] = None
-    lines = diff.splitlines()
-    for line in lines[4:]:  # Ignore header
-        if line.startswith(("---", "+++", "//")):
-            continue
-        elif line.startswith("@@"):
-            if active_annotation:
-                annotations.append(active_annotation)
-            _new_index = line.split(" ")[2]
-            if "," in _new_index:
-                new_start = _new_index[1:].split(",")[0]
-            else:
-                new_start = _new_index[1:]
+    # Skip the header; everything of interest comes after the first hunk
+    hunks_start = diff.find("\n@@")
+    if hunks_start == -1:
+        return annotations
+    active_annotation = DiffAnnotation(0, [])
+    for match in _DIFF_LINE_RE.finditer(diff, hunks_start + 1):
+        new_start = match.group("new_start")
+        if new_start is not None:
             active_annotation = DiffAnnotation(int(new_start), [])
-        elif line.startswith(("+", "-")):
-            if not active_annotation:
-                raise UserError("Invalid diff")
-            active_annotation.message.append(line)
-    if active_annotation:
-        annotations.append(active_annotation)
+            annotations.append(active_annotation)
+        else:
+            active_annotation.message.append(match.group("change"))
     annotations.sort(key=lambda a: a.start)
     return annotations
 
@@ -56,33 +63,28 @@ def _annotate_file_message(
     code_message: list[str], annotations: list[DiffAnnotation]
 ) -> list[str]:
     """Return the code_message with annotations inserted."""
-    active_index = 0
     annotated_message: list[str] = []
+    active_index = 0
     for annotation in annotations:
         # Fill-in lines between annotations
-        if active_index < annotation.start:
-            unaffected_lines = code_message[active_index : annotation.start]
-            annotated_message += unaffected_lines
+        annotated_message += code_message[active_index : annotation.start]
         active_index = annotation.start
         if annotation.start == 0:
             # Make sure the PATH stays on line 1
             annotated_message.append(code_message[0])
             active_index += 1
-        i_minus = None
-        for line in annotation.message:
-            sign = line[0]
-            if sign == "+":
-                # Add '+' lines in place of code_message lines
-                annotated_message.append(f"{active_index}:{line}")
-                active_index += 1
-                i_minus = None
-            elif sign == "-":
-                # Insert '-' lines at the point they were removed
-                i_minus = 0 if i_minus is None else i_minus
-                annotated_message.append(f"{annotation.start + i_minus}:{line}")
-                i_minus += 1
-    if active_index < len(code_message):
-        annotated_message += code_message[active_index:]
+        # git lists a hunk's '-' lines before its '+' lines. '-' lines are inserted
+        # at the point they were removed, '+' lines take the place of code_message lines
+        removed = [line for line in annotation.message if line[0] == "-"]
+        added = [line for line in annotation.message if line[0] == "+"]
+        annotated_message += [
+            f"{i}:{line}" for i, line in enumerate(removed, start=annotation.start)
+        ]
+        annotated_message += [
+            f"{i}:{line}" for i, line in enumerate(added, start=active_index)
+        ]
+        active_index += len(added)
+    annotated_message += code_message[active_index:]
 
     return annotated_message
 
@@ -103,63 +105,117 @@ class DiffContext:
         else:
             self.target = target
             self.name = name
+        self._head_exists = False
+        # Maps rel_path -> (diff, file_message, annotated file_message)
+        self._annotated = dict[Path, tuple[str, tuple[str, ...], list[str]]]()
+
+    def _check_head_exists(self) -> bool:
+        # Once the repo has a commit we don't need to keep asking git
+        if not self._head_exists:
+            self._head_exists = check_head_exists(self.config.git_root)
+        return self._head_exists
 
     @property
     def files(self) -> list[Path]:
-        if self.target == "HEAD" and not check_head_exists(self.config.git_root):
+        if self.target == "HEAD" and not self._check_head_exists():
             return []  # A new repo without any commits
         return get_files_in_diff(self.config.git_root, self.target)
 
+    def get_diffs(
+        self, rel_paths: Iterable[Path], files: Optional[list[Path]] = None
+    ) -> dict[Path, str]:
+        """
+        Return the diffs of those rel_paths that are in the diff, fetched with a single
+        git call. Pass files if the caller already has them to skip listing them again.
+        """
+        if files is None:
+            files = self.files
+        in_diff = set(files)
+        paths = [rel_path for rel_path in rel_paths if rel_path in in_diff]
+        if not paths:
+            return {}
+        return get_diffs_for_files(self.config.git_root, self.target, paths)
+
     def display_context(self) -> None:
-        if not self.files:
+        if self.target == "HEAD" and not self._check_head_exists():
+            return  # A new repo without any commits
+        shortstat = _git_command(
+            self.config.git_root, "diff", "--shortstat", self.target, "--"
+        )
+        if not shortstat:
             return
         cprint("Diff annotations:", "green")
-        num_files = len(self.files)
-        num_lines = 0
         # TODO: Only include paths in context
-        for file in self.files:
-            diff = get_diff_for_file(self.config.git_root, self.target, file)
-            diff_lines = diff.splitlines()
-            num_lines += len(
-                [line for line in diff_lines if line.startswith(("+ ", "- "))]
-            )
+        counts = {kind: int(n) for n, kind in _SHORTSTAT_RE.findall(shortstat)}
+        num_files = counts.get("file", 0)
+        num_lines = counts.get("insertion", 0) + counts.get("deletion", 0)
         print(f" ─•─ {self.name} | {num_files} files | {num_lines} lines\n")
 
     def annotate_file_message(
-        self, rel_path: Path, file_message: list[str]
+        self, rel_path: Path, file_message: list[str], diff: Optional[str] = None
     ) -> list[str]:
-        """Return file_message annotated with active diff."""
-        if not self.files:
-            return file_message
-
-        diff = get_diff_for_file(self.config.git_root, self.target, rel_path)
-        annotations = _parse_diff(diff)
-        return _annotate_file_message(file_message, annotations)
+        """
+        Return file_message annotated with active diff. If the file's diff was
+        already fetched (e.g. by get_diffs) it can be passed in to skip calling git.
+        """
+        if diff is None:
+            if not self.files:
+                return file_message
+            diff = get_diff_for_file(self.config.git_root, self.target, rel_path)
+
+        # Files usually come back unchanged between messages, so reuse the last
+        # annotation of each file while both its diff and its message match
+        key = tuple(file_message)
+        cached = self._annotated.get(rel_path)
+        if cached is not None and cached[0] == diff and cached[1] == key:
+            return cached[2]
+        annotated = _annotate_file_message(file_message, _parse_diff(diff))
+        self._annotated[rel_path] = (diff, key, annotated)
+        return annotated
 
 
 TreeishType = Literal["commit", "branch", "relative"]
 
 
-def _git_command(git_root: Path, *args: str) -> str | None:
+def _git_command(git_root: Path, *args: str, input: str | None = None) -> str | None:
     try:
         return subprocess.check_output(
-            ["git"] + list(args), cwd=git_root, stderr=subprocess.PIPE, text=True
+            ["git"] + list(args),
+            cwd=git_root,
+            stderr=subprocess.PIPE,
+            text=True,
+            input=input,
         ).strip()
     except subprocess.CalledProcessError:
         return None
 
 
 def _get_treeish_type(git_root: Path, treeish: str) -> TreeishType:
-    object_type = _git_command(git_root, "cat-file", "-t", treeish)
+    # Look up both the treeish and a branch with its name in a single git process.
+    # Branches may also be given as heads/<name> or refs/heads/<name>.
+    branch = _BRANCH_PREFIX_RE.sub("", treeish, count=1)
+    # Only a plain refname can be a branch; with a revision suffix (e.g. master@{1})
+    # the probe would resolve through the branch's ref
+    probe_branch = not any(c in branch for c in ("@{", "^", "~", ":"))
+    object_types = _git_command(
+        git_root,
+        "cat-file",
+        "--batch-check=%(objecttype)",
+        input=f"{treeish}\nrefs/heads/{branch}\n" if probe_branch else f"{treeish}\n",
+    )
+    if not object_types:
+        raise UserError(f"Invalid treeish: {treeish}")
+    object_type, _, branch_object_type = object_types.partition("\n")
 
-    if not object_type:
+    # Unresolvable names are echoed back as '<name> missing' or '<name> ambiguous'
+    if object_type.endswith(("missing", "ambiguous")):
         raise UserError(f"Invalid treeish: {treeish}")
 
     if object_type == "commit":
         if "~" in treeish or "^" in treeish:
             return "relative"
 
-        if _git_command(git_root, "show-ref", "--heads", treeish):
+        if branch_object_type == "commit":
             return "branch"
         else:
             return "commit"
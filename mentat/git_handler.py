@@ -1,10 +1,13 @@
 import logging
 import os
+import re
 import subprocess
 from pathlib import Path
 
 from mentat.errors import UserError
 
+_DIFF_HEADER_RE = re.compile(r"^diff --git .*$", re.MULTILINE)
+
 
 def get_git_diff_for_path(git_root: Path, path: Path) -> str:
     return subprocess.check_output(["git", "diff", path], cwd=git_root).decode("utf-8")
@@ -115,6 +118,49 @@ def get_diff_for_file(git_root: Path, target: str, path: Path) -> str:
         raise UserError()
 
 
+def get_diffs_for_files(
+    git_root: Path, target: str, paths: list[Path]
+) -> dict[Path, str]:
+    """Return the diff of each path for target versus active code in one git call"""
+    try:
+        # Pin the prefixes so the headers below match whatever diff.noprefix or
+        # diff.mnemonicPrefix the user has configured
+        diff_content = subprocess.check_output(
+            [
+                "git",
+                "diff",
+                "-U0",
+                "--src-prefix=a/",
+                "--dst-prefix=b/",
+                f"{target}",
+                "--",
+                *paths,
+            ],
+            cwd=git_root,
+            text=True,
+        )
+    except subprocess.CalledProcessError:
+        logging.error(f"Error obtaining diff for commit '{target}'.")
+        raise UserError()
+
+    headers = {
+        f"diff --git a/{path.as_posix()} b/{path.as_posix()}": path for path in paths
+    }
+    diffs = dict[Path, str]()
+    # Only slice out the diffs we were asked for, and without splitting them apart
+    matches = list(_DIFF_HEADER_RE.finditer(diff_content))
+    ends = [match.start() for match in matches[1:]] + [len(diff_content)]
+    for match, end in zip(matches, ends):
+        path = headers.get(match.group(0))
+        if path is not None:
+            diffs[path] = diff_content[match.start() : end].strip()
+    # Paths that git quotes in the header won't match, so diff those individually
+    for path in paths:
+        if path not in diffs:
+            diffs[path] = get_diff_for_file(git_root, target, path)
+    return diffs
+
+
 def get_treeish_metadata(git_root: Path, target: str) -> dict[str, str]:
     try:
         commit_info = subprocess.check_output(
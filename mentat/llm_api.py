@@ -1,26 +1,34 @@
+from __future__ import annotations
+
 import logging
 import os
 import sys
 from dataclasses import dataclass
-from typing import Any, AsyncGenerator, Optional, cast
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Optional, cast
 
-import openai
-import tiktoken
 from dotenv import load_dotenv
-from openai.error import AuthenticationError
 from termcolor import cprint
 
 from .config_manager import mentat_dir_path
 from .errors import MentatError, UserError
 
+if TYPE_CHECKING:
+    import tiktoken
+
 package_name = __name__.split(".")[0]
 
 # openai doesn't seem to use type hints, so we have to use type: ignore and cast everywhere
+# openai and tiktoken are slow to import, so they're only imported by the functions
+# that use them; most importers of this module just need token counts and model info
 
 
 # Check for .env file or already exported API key
 # If no api key found, raise an error
 def setup_api_key():
+    import openai
+    from openai.error import AuthenticationError
+
     if not load_dotenv(mentat_dir_path / ".env"):
         load_dotenv()
     key = os.getenv("OPENAI_API_KEY")
@@ -50,6 +58,8 @@ async def call_llm_api(
         logging.critical("OpenAI call attempted in non benchmark test environment!")
         raise MentatError("OpenAI call attempted in non benchmark test environment!")
 
+    import openai
+
     response: AsyncGenerator[Any, None] = cast(
         AsyncGenerator[Any, None],
         await openai.ChatCompletion.acreate(  # type: ignore
@@ -63,18 +73,23 @@ async def call_llm_api(
     return response
 
 
-def count_tokens(message: str, model: str) -> int:
+@lru_cache(maxsize=None)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    import tiktoken
+
     try:
-        return len(
-            tiktoken.encoding_for_model(model).encode(message, disallowed_special=())
-        )
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        return len(
-            tiktoken.encoding_for_model("gpt-4").encode(message, disallowed_special=())
-        )
+        return tiktoken.encoding_for_model("gpt-4")
+
+
+def count_tokens(message: str, model: str) -> int:
+    return len(_get_encoding(model).encode(message, disallowed_special=()))
 
 
 def is_model_available(model: str) -> bool:
+    import openai
+
     available_models: list[str] = cast(
         list[str], [x["id"] for x in openai.Model.list()["data"]]  # type: ignore
     )
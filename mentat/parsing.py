@@ -8,7 +8,6 @@ from timeit import default_timer
 from typing import Any, AsyncGenerator
 
 import attr
-from openai.error import InvalidRequestError, RateLimitError
 from termcolor import cprint
 
 from .code_change import CodeChange, CodeChangeAction
@@ -159,6 +158,9 @@ def run_async_stream_and_parse_llm_response(
     model: str,
     code_file_manager: CodeFileManager,
 ) -> ParsingState:
+    # Imported here rather than at the top, as openai is slow to import
+    from openai.error import InvalidRequestError, RateLimitError
+
     state: ParsingState = ParsingState()
     start_time = default_timer()
     try:
@@ -1,5 +1,8 @@
+from functools import lru_cache
 from textwrap import dedent
 
+from .llm_api import count_tokens
+
 system_prompt = """
     You are part of an automated coding system. As such, responses must adhere strictly
     to the required format, so they can be parsed programmaticaly. Your input will
@@ -207,3 +210,8 @@ system_prompt = """
     @@end
 """
 system_prompt = dedent(system_prompt).strip()
+
+
+@lru_cache(maxsize=None)
+def system_prompt_token_count(model: str) -> int:
+    return count_tokens(system_prompt, model)
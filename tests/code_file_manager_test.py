@@ -1,7 +1,10 @@
 import os
+from pathlib import Path
 from textwrap import dedent
 
+from mentat import diff_context
 from mentat.app import run
+from mentat.code_change import CodeChange
 from mentat.code_context import CodeContext
 from mentat.code_file_manager import CodeFileManager
 from mentat.user_input_manager import UserInputManager
@@ -117,3 +120,187 @@ def test_run_from_subdirectory(
         echo_output = f.readlines()
     assert calculator_output[0].strip() == "# Hello"
     assert echo_output[0].strip() == "# Hello"
+
+
+def test_token_count_cached(mock_config, mocker):
+    file_path = "file.txt"
+    with open(file_path, "w") as file_file:
+        file_file.write("I am a file")
+    code_context = CodeContext(
+        config=mock_config,
+        paths=[file_path],
+        exclude_paths=[],
+    )
+    code_file_manager = CodeFileManager(
+        user_input_manager=UserInputManager(
+            config=mock_config, code_context=code_context
+        ),
+        config=mock_config,
+        code_context=code_context,
+    )
+    mock_count_tokens = mocker.patch(
+        "mentat.code_file_manager.count_tokens", return_value=1
+    )
+    mocker.patch("mentat.code_file_manager.system_prompt_token_count", return_value=1)
+    mocker.patch.object(code_context.code_map, "get_message", return_value=None)
+
+    code_file_manager.get_code_message(mock_config.model())
+    # One count for the header and one for the file
+    assert mock_count_tokens.call_count == 2
+
+    code_file_manager.get_code_message(mock_config.model())
+    # Unchanged file isn't re-tokenized
+    assert mock_count_tokens.call_count == 3
+
+    with open(file_path, "w") as file_file:
+        file_file.write("I am a changed file")
+    code_file_manager.get_code_message(mock_config.model())
+    assert mock_count_tokens.call_count == 5
+
+
+def test_code_map_skipped_when_context_full(mock_config, mocker):
+    file_path = "file.txt"
+    with open(file_path, "w") as file_file:
+        file_file.write("I am a file")
+    code_context = CodeContext(
+        config=mock_config,
+        paths=[file_path],
+        exclude_paths=[],
+    )
+    code_file_manager = CodeFileManager(
+        user_input_manager=UserInputManager(
+            config=mock_config, code_context=code_context
+        ),
+        config=mock_config,
+        code_context=code_context,
+    )
+    mocker.patch("mentat.code_file_manager.count_tokens", return_value=100000)
+    mocker.patch("mentat.code_file_manager.system_prompt_token_count", return_value=1)
+    mock_get_message = mocker.patch.object(code_context.code_map, "get_message")
+
+    code_message = code_file_manager.get_code_message(mock_config.model())
+    mock_get_message.assert_not_called()
+    assert "Code Map" not in code_message
+
+
+def test_code_message_diff_annotations(mock_config, mocker):
+    echo_path = os.path.join("scripts", "echo.py")
+    with open(echo_path) as f:
+        lines = f.read().split("\n")
+    lines[4] = "    return value * 2"
+    with open(echo_path, "w") as f:
+        f.write("\n".join(lines))
+    # A changed file outside of context shouldn't have its diff fetched
+    with open("scripts/calculator.py", "a") as f:
+        f.write("# edited\n")
+
+    code_context = CodeContext(
+        config=mock_config,
+        paths=[echo_path, os.path.join("scripts", "graph_class.py")],
+        exclude_paths=[],
+        no_code_map=True,
+    )
+    code_file_manager = CodeFileManager(
+        user_input_manager=UserInputManager(
+            config=mock_config, code_context=code_context
+        ),
+        config=mock_config,
+        code_context=code_context,
+    )
+    spy = mocker.spy(diff_context, "get_diffs_for_files")
+    code_message = code_file_manager.get_code_message(mock_config.model())
+    assert spy.call_args.args[2] == [Path("scripts/echo.py")]
+
+    code_message_lines = code_message.split("\n")
+    assert code_message_lines[:3] == [
+        "Diff References:",
+        ' "-" = HEAD (last commit)',
+        ' "+" = Active Changes',
+    ]
+    assert "5:-    return value" in code_message_lines
+    assert "5:+    return value * 2" in code_message_lines
+    assert "scripts/graph_class.py" in code_message_lines
+
+
+def test_code_message_rereads_changed_files(mock_config):
+    file_path = "file.txt"
+    with open(file_path, "w") as file_file:
+        file_file.write("first version")
+    code_context = CodeContext(
+        config=mock_config,
+        paths=[file_path],
+        exclude_paths=[],
+        no_code_map=True,
+    )
+    code_file_manager = CodeFileManager(
+        user_input_manager=UserInputManager(
+            config=mock_config, code_context=code_context
+        ),
+        config=mock_config,
+        code_context=code_context,
+    )
+    code_message = code_file_manager.get_code_message(mock_config.model())
+    assert "1:first version" in code_message.split("\n")
+
+    with open(file_path, "w") as file_file:
+        file_file.write("second, longer version")
+    code_message = code_file_manager.get_code_message(mock_config.model())
+    assert "1:second, longer version" in code_message.split("\n")
+
+    # An edit that keeps the size is still picked up by its mtime; bump it
+    # explicitly in case the filesystem's timestamps are coarse
+    with open(file_path, "w") as file_file:
+        file_file.write("edited, longer version")
+    stat = os.stat(file_path)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    code_message = code_file_manager.get_code_message(mock_config.model())
+    assert "1:edited, longer version" in code_message.split("\n")
+
+
+def test_file_changed_while_generating(mock_config, mock_collect_user_input):
+    file_path = "file.txt"
+    with open(file_path, "w") as file_file:
+        file_file.write("a\nb\nc")
+    code_context = CodeContext(
+        config=mock_config,
+        paths=[file_path],
+        exclude_paths=[],
+        no_code_map=True,
+    )
+    code_file_manager = CodeFileManager(
+        user_input_manager=UserInputManager(
+            config=mock_config, code_context=code_context
+        ),
+        config=mock_config,
+        code_context=code_context,
+    )
+
+    def replace_first_line(new_line):
+        return CodeChange(
+            {"file": file_path, "action": "replace", "start-line": 1, "end-line": 1},
+            [new_line],
+            code_file_manager,
+        )
+
+    # Unchanged since it was read: no prompt
+    code_file_manager.get_code_message(mock_config.model())
+    code_file_manager.write_changes_to_files([replace_first_line("A")])
+    mock_collect_user_input.assert_not_called()
+    with open(file_path) as file_file:
+        assert file_file.read() == "A\nb\nc"
+
+    # Edited after it was read: ask before erasing the edit
+    code_file_manager.get_code_message(mock_config.model())
+    with open(file_path, "w") as file_file:
+        file_file.write("A\nB\nc")
+    mock_collect_user_input.side_effect = ["n"]
+    code_file_manager.write_changes_to_files([replace_first_line("1")])
+    mock_collect_user_input.assert_called_once()
+    with open(file_path) as file_file:
+        assert file_file.read() == "A\nB\nc"
+
+    mock_collect_user_input.side_effect = ["y"]
+    code_file_manager.write_changes_to_files([replace_first_line("1")])
+    assert mock_collect_user_input.call_count == 2
+    with open(file_path) as file_file:
+        assert file_file.read() == "1\nb\nc"
@@ -59,6 +59,19 @@ def pytest_configure(config):
         "markers", "uitest: run ui-tests that get evaluated by humans"
     )
 
+    # Build the temporary testbed repos on a RAM-backed tmpfs where there is one,
+    # so git's index and object writes never wait on the disk. An explicit
+    # --basetemp or TMPDIR still wins. Setting TMPDIR rather than only
+    # tempfile.tempdir carries this over to pytest-xdist workers, which inherit
+    # the controller's environment (and get a --basetemp of their own from it).
+    if (
+        config.option.basetemp is None
+        and "TMPDIR" not in os.environ
+        and os.path.isdir("/dev/shm")
+        and os.access("/dev/shm", os.W_OK)
+    ):
+        os.environ["TMPDIR"] = tempfile.tempdir = "/dev/shm"
+
 
 def pytest_collection_modifyitems(config, items):
     benchmark = config.getoption("--benchmark")
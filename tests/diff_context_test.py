@@ -1,61 +1,244 @@
 import os
+import shutil
 import subprocess
+import sys
+from functools import lru_cache
 from pathlib import Path
 
 import pytest
 
-from mentat.diff_context import DiffContext, get_diff_context
+from mentat import git_handler
+from mentat.config_manager import ConfigManager
+from mentat.diff_context import (
+    DiffContext,
+    _annotate_file_message,
+    _parse_diff,
+    get_diff_context,
+)
 from mentat.errors import UserError
+from mentat.git_handler import get_diff_for_file, get_diffs_for_files
 
 rel_path = Path("multifile_calculator/operations.py")
 
+# Settings for the test repos, passed through the environment (GIT_CONFIG_COUNT,
+# git >= 2.31) rather than spending git calls on `git config`: no hooks, auto-gc or
+# signing when committing, and no fsync (git >= 2.36; ignored by older versions)
+_GIT_CONFIG = {
+    "core.fsync": "none",
+    "gc.auto": "0",
+    "core.hooksPath": os.devnull,
+    "commit.gpgsign": "false",
+}
 
-def _update_ops(temp_testbed, last_line, commit_message=None):
+# Commit as a test user and ignore the developer's global and system git config,
+# so the test repos behave the same everywhere
+_GIT_ENV = {
+    **os.environ,
+    "GIT_AUTHOR_NAME": "Test User",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "Test User",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+    "GIT_CONFIG_GLOBAL": os.devnull,
+    "GIT_CONFIG_NOSYSTEM": "1",
+    "GIT_TERMINAL_PROMPT": "0",
+    "GIT_CONFIG_COUNT": str(len(_GIT_CONFIG)),
+}
+for i, (key, value) in enumerate(_GIT_CONFIG.items()):
+    _GIT_ENV[f"GIT_CONFIG_KEY_{i}"] = key
+    _GIT_ENV[f"GIT_CONFIG_VALUE_{i}"] = value
+
+
+def _git(args, cwd, check=True):
+    # Git is only run for its side effects here, so don't pipe its chatter through
+    # pytest's output capture; its errors are only passed on if it fails
+    result = subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        env=_GIT_ENV,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if check and result.returncode:
+        print(result.stderr, file=sys.stderr)
+        result.check_returncode()
+    return result
+
+
+def _update_ops(ops_path: Path, last_line, commit_message=None):
     # Update the last line of operations.py and (optionally) commit
-    abs_path = os.path.join(temp_testbed, "multifile_calculator", "operations.py")
-    with open(abs_path, "r") as f:
-        lines = f.readlines()
-    lines[-1:] = [
-        f"    return {last_line}\n",
-    ]
-    with open(abs_path, "w") as f:
-        f.writelines(lines)
+    text = ops_path.read_text()
+    last_line_start = text.rstrip("\n").rfind("\n") + 1
+    ops_path.write_text(text[:last_line_start] + f"    return {last_line}\n")
     if commit_message:
-        subprocess.run(["git", "add", abs_path], cwd=temp_testbed)
-        subprocess.run(["git", "commit", "-m", commit_message], cwd=temp_testbed)
+        # Committing a tracked path directly stages it too, saving a `git add`
+        _git(
+            ["commit", "--no-verify", "-m", commit_message, "--", ops_path],
+            ops_path.parent,
+        )
 
 
-@pytest.fixture
-def git_history(mock_config, temp_testbed):
-    """Load a git repo with the following branches/commits:
+@pytest.fixture(scope="session")
+def git_history_template(tmp_path_factory):
+    """Build a testbed repo once per session with the following branches/commits:
 
-    main
-      'a / b' (from temp_testbed)
+    master
+      'a / b' (add testbed)
       'commit2'
       'commit3'
     test_branch (from commit2)
       'commit4'
     """
-    _update_ops(temp_testbed, "commit2", "commit2")
-    _update_ops(temp_testbed, "commit3", "commit3")
-    subprocess.run(["git", "checkout", "HEAD~1"], cwd=temp_testbed)
-    subprocess.run(["git", "checkout", "-b", "test_branch"], cwd=temp_testbed)
+    # tmp_path_factory is unique per pytest-xdist worker, so each worker builds its
+    # own template; sharing one would let workers' worktrees fight over branches.
+    # resolve() follows symlinks, required for paths to match on macOS
+    template = tmp_path_factory.mktemp("template").resolve() / "testbed"
+    shutil.copytree("testbed", template)
+    shutil.copy(".gitignore", template)
+    for args in [
+        ["init"],
+        ["add", "."],
+        ["commit", "--no-verify", "-m", "add testbed"],
+    ]:
+        _git(args, template)
+
+    ops_path = template / rel_path
+    _update_ops(ops_path, "commit2", "commit2")
+    _update_ops(ops_path, "commit3", "commit3")
+    _git(["checkout", "-b", "test_branch", "HEAD~1"], template)
     # commit4
-    _update_ops(temp_testbed, "commit4", "commit4")
+    _update_ops(ops_path, "commit4", "commit4")
     # Return on master commit3
-    subprocess.run(["git", "checkout", "master"], cwd=temp_testbed)
+    _git(["checkout", "master"], template)
+    return template
+
+
+@pytest.fixture(autouse=True)
+def temp_testbed(monkeypatch, tmp_path, git_history_template):
+    # Overrides the conftest testbed: rather than building a new repo and history
+    # for every test, check out a detached worktree of the session's template
+    temp_testbed = str(tmp_path.resolve() / "testbed")
+    _git(["worktree", "add", "--detach", temp_testbed, "master"], git_history_template)
+
+    with monkeypatch.context() as m:
+        m.chdir(temp_testbed)
+        yield temp_testbed
+
+    _git(["worktree", "remove", "--force", temp_testbed], git_history_template)
+
+
+@pytest.fixture
+def ops_path(temp_testbed):
+    return Path(temp_testbed, rel_path)
+
+
+@pytest.fixture(scope="session")
+def git_history(git_history_template):
+    """SHAs of the commits on master (which the testbed has checked out)"""
+    revs = ["HEAD", "HEAD~1", "HEAD~2"]
+    shas = subprocess.check_output(
+        ["git", "rev-parse", *revs],
+        cwd=git_history_template,
+        env=_GIT_ENV,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    ).split()
+    return dict(zip(revs, shas))
+
+
+@pytest.fixture(scope="module")
+def diff_contexts(git_history_template, git_history):
+    """DiffContexts for the read-only targets, keyed by diff argument.
+
+    These are built once against the template rather than per test: it stays clean
+    on master, just like each test's fresh worktree, so the contexts see the same
+    diffs. Tests that change files or checkouts must build their own.
+    """
+    config = ConfigManager(Path(git_history_template))
+    config.project_config = {}
+    targets = [git_history["HEAD~2"], "test_branch", "HEAD~2"]
+    return {target: get_diff_context(config, diff=target) for target in targets}
+
+
+@lru_cache(maxsize=32)
+def _format_file_message(text: str) -> tuple[str, ...]:
+    lines = text.splitlines(keepends=True)
+    return (
+        "/multifile_calculator/operations.py",
+        *(f"{i}:{line}" for i, line in enumerate(lines)),
+    )
+
+
+def _get_file_message(ops_path: Path):
+    text = ops_path.read_text()
+    # Every test gets its own worktree, so key on the contents: most tests see the
+    # same operations.py and can share the formatted message. Callers get a copy.
+    return list(_format_file_message(text))
+
 
+_DIFF_HEADER = """\
+diff --git a/file.py b/file.py
+index 1111111..2222222 100644
+--- a/file.py
++++ b/file.py
+"""
 
-def _get_file_message(temp_testbed):
-    abs_path = os.path.join(temp_testbed, "multifile_calculator", "operations.py")
-    file_message = ["/multifile_calculator/operations.py"]
-    with open(abs_path, "r") as f:
-        for i, line in enumerate(f.readlines()):
-            file_message.append(f"{i}:{line}")
-    return file_message
 
+@pytest.mark.parametrize(
+    "hunks, new_lines, expected",
+    [
+        pytest.param(
+            "@@ -2,0 +3,2 @@\n+X\n+Y",
+            ["a", "b", "X", "Y", "c"],
+            ["1:a", "2:b", "3:+X", "4:+Y", "5:c"],
+            id="insertion",
+        ),
+        # git starts a pure deletion at the line before it; like the original
+        # annotator, the removed lines are inserted ahead of that line
+        pytest.param(
+            "@@ -2,2 +1,0 @@\n-b\n-c",
+            ["a", "d"],
+            ["1:-b", "2:-c", "1:a", "2:d"],
+            id="deletion",
+        ),
+        pytest.param(
+            "@@ -1 +1 @@\n-a\n+A",
+            ["A", "b"],
+            ["1:-a", "1:+A", "2:b"],
+            id="first-line",
+        ),
+        # Deleting the first line starts the hunk at line 0, which must not
+        # displace the path
+        pytest.param(
+            "@@ -1 +0,0 @@\n-a",
+            ["b", "c"],
+            ["0:-a", "1:b", "2:c"],
+            id="line-zero",
+        ),
+        pytest.param(
+            "@@ -1 +1 @@\n-a\n+A\n@@ -3,2 +3 @@\n-c\n-d\n+C\n@@ -6,0 +6 @@\n+g",
+            ["A", "b", "C", "e", "f", "g"],
+            ["1:-a", "1:+A", "2:b", "3:-c", "4:-d", "3:+C", "4:e", "5:f", "6:+g"],
+            id="multiple-hunks",
+        ),
+        # A removed line starting with '--' reads like a '---' file header, and is
+        # skipped as it always has been
+        pytest.param(
+            "@@ -1 +1 @@\n--- comment\n+# comment",
+            ["# comment", "b"],
+            ["1:+# comment", "2:b"],
+            id="removed-dashes",
+        ),
+    ],
+)
+def test_annotate_file_message(hunks, new_lines, expected):
+    code_message = ["file.py", *(f"{i}:{line}" for i, line in enumerate(new_lines, 1))]
+    annotations = _parse_diff(_DIFF_HEADER + hunks)
+    annotated_message = _annotate_file_message(code_message + [""], annotations)
+    assert annotated_message == ["file.py", *expected, ""]
 
-def test_diff_context_default(mock_config, temp_testbed, git_history):
+
+def test_diff_context_default(mock_config, ops_path, git_history):
     # DiffContext.__init__() (default): active code vs last commit
     diff_context = DiffContext(mock_config)
     assert diff_context.config
@@ -64,68 +247,115 @@ def test_diff_context_default(mock_config, temp_testbed, git_history):
     assert diff_context.files == []
 
     # DiffContext.files (property): return git-tracked files with active changes
-    _update_ops(temp_testbed, "commit5")
+    _update_ops(ops_path, "commit5")
     assert diff_context.files == [rel_path]
 
     # DiffContext.annotate_file_message(): modify file_message with diff
-    file_message = _get_file_message(temp_testbed)
+    file_message = _get_file_message(ops_path)
     annotated_message = diff_context.annotate_file_message(rel_path, file_message)
     expected = file_message[:-1] + [
         "14:-    return commit3",
         "14:+    return commit5",
     ]
     assert annotated_message == expected
+    assert (
+        diff_context.annotate_file_message(rel_path, file_message) is annotated_message
+    )
 
+    # Changing the file invalidates the cached annotation
+    _update_ops(ops_path, "commit6")
+    file_message = _get_file_message(ops_path)
+    annotated_message = diff_context.annotate_file_message(rel_path, file_message)
+    assert annotated_message[-1] == "14:+    return commit6"
 
-def test_diff_context_commit(mock_config, temp_testbed, git_history):
-    # Get the hash of 2-commits-ago
-    last_commit = subprocess.check_output(
-        ["git", "rev-parse", "HEAD~2"], cwd=temp_testbed, text=True
-    ).strip()
-    diff_context = get_diff_context(mock_config, diff=last_commit)
-    assert diff_context.target == last_commit
-    assert diff_context.name == f"{last_commit[:8]}: add testbed"
-    assert diff_context.files == [rel_path]
 
-    file_message = _get_file_message(temp_testbed)
-    annotated_message = diff_context.annotate_file_message(rel_path, file_message)
-    expected = file_message[:-1] + [
-        "14:-    return a / b",
-        "14:+    return commit3",
-    ]
-    assert annotated_message == expected
+def test_diff_context_display_context(mock_config, temp_testbed, ops_path, capsys):
+    diff_context = DiffContext(mock_config)
+    # A clean tree has nothing to display
+    diff_context.display_context()
+    assert capsys.readouterr().out == ""
 
+    _update_ops(ops_path, "commit5")
+    diff_context.display_context()
+    lines = capsys.readouterr().out.split("\n")
+    assert "Diff annotations:" in lines[0]
+    assert lines[1] == " ─•─ HEAD (last commit) | 1 files | 2 lines"
 
-def test_diff_context_branch(mock_config, temp_testbed, git_history):
-    diff_context = get_diff_context(mock_config, diff="test_branch")
-    assert diff_context.target == "test_branch"
-    assert diff_context.name.startswith("Branch test_branch:")
-    assert diff_context.name.endswith(": commit4")
+    # --shortstat pluralizes its counts once there's more than one
+    with open(Path(temp_testbed, "scripts", "echo.py"), "a") as f:
+        f.write("# one\n# two\n# three\n")
+    diff_context.display_context()
+    lines = capsys.readouterr().out.split("\n")
+    assert lines[1] == " ─•─ HEAD (last commit) | 2 files | 5 lines"
+
+
+@pytest.mark.parametrize(
+    "rev, by_sha, name_prefix, summary, removed_line",
+    [
+        # Commits are named after their short SHA, which is only known at runtime
+        pytest.param("HEAD~2", True, None, "add testbed", "a / b", id="commit"),
+        pytest.param(
+            "test_branch",
+            False,
+            "Branch test_branch: ",
+            "commit4",
+            "commit4",
+            id="branch",
+        ),
+        pytest.param(
+            "HEAD~2", False, "HEAD~2: ", "add testbed", "a / b", id="relative"
+        ),
+    ],
+)
+def test_diff_context_target(
+    ops_path,
+    git_history,
+    diff_contexts,
+    rev,
+    by_sha,
+    name_prefix,
+    summary,
+    removed_line,
+):
+    # Diff against a commit (by SHA), a branch, or a relative treeish
+    diff = git_history[rev] if by_sha else rev
+    diff_context = diff_contexts[diff]
+    assert diff_context.target == diff
+    assert diff_context.name.startswith(name_prefix or f"{diff[:8]}: ")
+    assert diff_context.name.endswith(f": {summary}")
     assert diff_context.files == [rel_path]
 
-    file_message = _get_file_message(temp_testbed)
+    file_message = _get_file_message(ops_path)
     annotated_message = diff_context.annotate_file_message(rel_path, file_message)
     expected = file_message[:-1] + [
-        "14:-    return commit4",
+        f"14:-    return {removed_line}",
         "14:+    return commit3",
     ]
     assert annotated_message == expected
+    # Annotating the same message against the same diff is cached
+    assert (
+        diff_context.annotate_file_message(rel_path, file_message) is annotated_message
+    )
 
 
-def test_diff_context_relative(mock_config, temp_testbed, git_history):
-    diff_context = get_diff_context(mock_config, diff="HEAD~2")
-    assert diff_context.target == "HEAD~2"
-    assert diff_context.name.startswith("HEAD~2: ")
-    assert diff_context.name.endswith(": add testbed")
-    assert diff_context.files == [rel_path]
+@pytest.mark.parametrize(
+    "diff", ["test_branch", "heads/test_branch", "refs/heads/test_branch"]
+)
+def test_diff_context_branch_names(mock_config, diff):
+    diff_context = get_diff_context(mock_config, diff=diff)
+    assert diff_context.target == diff
+    assert diff_context.name.startswith(f"Branch {diff}: ")
+    assert diff_context.name.endswith(": commit4")
 
-    file_message = _get_file_message(temp_testbed)
-    annotated_message = diff_context.annotate_file_message(rel_path, file_message)
-    expected = file_message[:-1] + [
-        "14:-    return a / b",
-        "14:+    return commit3",
-    ]
-    assert annotated_message == expected
+
+@pytest.mark.parametrize(
+    "diff, rev", [("master@{0}", "HEAD"), ("heads/master@{1}", "HEAD~1")]
+)
+def test_diff_context_reflog_not_branch(mock_config, git_history, diff, rev):
+    # Reflog entries of a branch are commits, not the branch itself
+    diff_context = get_diff_context(mock_config, diff=diff)
+    assert diff_context.target == diff
+    assert diff_context.name.startswith(f"{git_history[rev][:8]}: ")
 
 
 def test_diff_context_errors(mock_config, temp_testbed, git_history):
@@ -141,13 +371,46 @@ def test_diff_context_errors(mock_config, temp_testbed, git_history):
 
 
 def test_diff_context_pr(mock_config, temp_testbed, git_history):
-    subprocess.run(["git", "checkout", "test_branch"], cwd=temp_testbed)
+    _git(["checkout", "test_branch"], temp_testbed)
     diff_context = get_diff_context(mock_config, pr_diff="master")
 
-    commit2 = subprocess.check_output(
-        ["git", "rev-parse", "HEAD~1"], cwd=temp_testbed, text=True
-    ).strip()
+    # test_branch and master share commit2 as their parent
+    commit2 = git_history["HEAD~1"]
     assert diff_context.target == commit2
     assert diff_context.name.startswith("Merge-base Branch master:")
     assert diff_context.name.endswith(": commit2")  # NOT the latest
     assert diff_context.files == [rel_path]
+
+
+def test_get_diffs(mock_config, temp_testbed, ops_path, mocker, monkeypatch):
+    testbed = Path(temp_testbed)
+    _update_ops(ops_path, "commit5")
+    echo_path = Path("scripts/echo.py")
+    with open(testbed / echo_path, "a") as f:
+        f.write("# edited\n")
+    # Git quotes non-ASCII paths in diff headers, so this one can't be sliced out of
+    # the batched diff and falls back to its own git call
+    quoted_path = Path("edité.py")
+    (testbed / quoted_path).write_text("x = 1\n")
+    # Set through the environment rather than the config the worktree shares with
+    # the template; git_handler's git processes inherit it
+    monkeypatch.setenv("GIT_CONFIG_COUNT", "1")
+    monkeypatch.setenv("GIT_CONFIG_KEY_0", "core.quotePath")
+    monkeypatch.setenv("GIT_CONFIG_VALUE_0", "true")
+    _git(["add", "--intent-to-add", quoted_path], testbed)
+
+    paths = [rel_path, echo_path, quoted_path]
+    spy = mocker.spy(git_handler, "get_diff_for_file")
+    diffs = get_diffs_for_files(testbed, "HEAD", paths)
+    spy.assert_called_once_with(testbed, "HEAD", quoted_path)
+    assert list(diffs) == paths
+    for path in paths:
+        assert diffs[path] == get_diff_for_file(testbed, "HEAD", path)
+
+    # DiffContext.get_diffs(): only files both in the diff and asked for
+    diff_context = DiffContext(mock_config)
+    unchanged_path = Path("multifile_calculator/calculator.py")
+    assert diff_context.get_diffs([rel_path, unchanged_path]) == {
+        rel_path: diffs[rel_path]
+    }
+    assert diff_context.get_diffs([unchanged_path]) == {}